@@ -1,5 +1,7 @@
 import asyncio
-import json
+import functools
+import hashlib
+import logging
 import os
 import socket
 from aiohttp import web
@@ -11,40 +13,112 @@ from aiortc import (
     RTCIceServer,
     VideoStreamTrack,
 )
-from aiortc.contrib.media import MediaBlackhole, MediaPlayer
+from aiortc.contrib.media import MediaPlayer
 from av import VideoFrame
 import numpy as np
 import aioice
+import orjson
+
+log = logging.getLogger(__name__)
 
 pcs = set()
 server_nat_info = None  # Store NAT detection results
+server_nat_json = b"null"  # server_nat_info, encoded once for every answer
 
 # STUN/TURN config – dit is de "STUN SERVER"
 # For SSH tunnel scenarios, we need TURN to relay traffic
+# aioice only uses the first STUN and the first TURN URL, and every peer
+# connection re-parses this list, so it lists just the servers actually used
 stun_config = RTCConfiguration(
     iceServers=[
         RTCIceServer(urls=["stun:stun.l.google.com:19302"]),
-        # Free TURN servers for testing
+        # Free TURN server for testing
         RTCIceServer(
-            urls=[
-                "turn:openrelay.metered.ca:80",
-                "turn:openrelay.metered.ca:443",
-                "turns:openrelay.metered.ca:443"
-            ],
+            urls=["turn:openrelay.metered.ca:80"],
             username="openrelayproject",
             credential="openrelayproject"
         ),
-        RTCIceServer(
-            urls=[
-                "turn:numb.viagenie.ca",
-            ],
-            username="webrtc@live.com",
-            credential="muazkh"
-        ),
     ]
 )
 
 
+def rgb_to_yuv420p(img):
+    """Convert an RGB24 image to BT.601 limited-range YUV420p planes."""
+    rgb = img.astype(np.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    y = 16 + (65.481 * r + 128.553 * g + 24.966 * b) / 255
+    u = 128 + (-37.797 * r - 74.203 * g + 112.0 * b) / 255
+    v = 128 + (112.0 * r - 93.786 * g - 18.214 * b) / 255
+
+    # Chroma is stored at half resolution: average every 2x2 block
+    height, width = y.shape
+    u = u.reshape(height // 2, 2, width // 2, 2).mean(axis=(1, 3))
+    v = v.reshape(height // 2, 2, width // 2, 2).mean(axis=(1, 3))
+    # C order keeps the per-frame copy into the AV planes a plain memcpy
+    return tuple(
+        np.round(plane).astype(np.uint8, order="C") for plane in (y, u, v)
+    )
+
+
+def plane_array(plane):
+    """Return a writable ndarray view of a video plane's pixels.
+
+    Rows may be padded to line_size for alignment; the padding is sliced off.
+    """
+    buf = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+    return buf[:, :plane.width]
+
+
+def render_bars(frame, background, counter):
+    """Render one color bars frame with the moving indicator into frame.
+
+    The YUV420p planes in background are copied straight into the frame's
+    own buffers, so the encoder gets the frame without an RGB conversion.
+    """
+    y, u, v = (plane_array(plane) for plane in frame.planes)
+    for out, plane in zip((y, u, v), background):
+        np.copyto(out, plane)
+
+    # Add a moving indicator (black is Y=16 with neutral chroma)
+    indicator_pos = counter % frame.width
+    y[:, indicator_pos:indicator_pos+5] = 16
+    u[:, indicator_pos // 2:(indicator_pos+6) // 2] = 128
+    v[:, indicator_pos // 2:(indicator_pos+6) // 2] = 128
+
+
+# The 7 vertical color bars, left to right
+_COLORS = np.array([
+    [255, 255, 255],  # White
+    [255, 255, 0],    # Yellow
+    [0, 255, 255],    # Cyan
+    [0, 255, 0],      # Green
+    [255, 0, 255],    # Magenta
+    [255, 0, 0],      # Red
+    [0, 0, 255],      # Blue
+], dtype=np.uint8)
+
+
+def _build_bars(width=640, height=480):
+    """Build the color bars test pattern as read-only YUV420p planes."""
+    # The last bar absorbs the remainder of the width
+    bar_width = width // len(_COLORS)
+    widths = np.full(len(_COLORS), bar_width)
+    widths[-1] = width - bar_width * (len(_COLORS) - 1)
+
+    # Build a single row of bars and broadcast it down the image
+    row = np.repeat(_COLORS, widths, axis=0)
+    img = np.broadcast_to(row, (height, width, 3))
+
+    planes = rgb_to_yuv420p(img)
+    for plane in planes:
+        plane.setflags(write=False)
+    return planes
+
+
+# The bars never change, so every track copies from this one shared pattern
+_COLOR_BARS_BG = _build_bars()
+
+
 class ColorBarsVideoTrack(VideoStreamTrack):
     """
     A video track that generates color bars test pattern.
@@ -52,56 +126,53 @@ class ColorBarsVideoTrack(VideoStreamTrack):
     def __init__(self):
         super().__init__()
         self.counter = 0
+        self._height, self._width = _COLOR_BARS_BG[0].shape
 
     async def recv(self):
         pts, time_base = await self.next_timestamp()
-        
-        # Create a color bars test pattern
-        width, height = 640, 480
-        img = np.zeros((height, width, 3), dtype=np.uint8)
-        
-        # Create 7 vertical color bars
-        bar_width = width // 7
-        colors = [
-            [255, 255, 255],  # White
-            [255, 255, 0],    # Yellow
-            [0, 255, 255],    # Cyan
-            [0, 255, 0],      # Green
-            [255, 0, 255],    # Magenta
-            [255, 0, 0],      # Red
-            [0, 0, 255],      # Blue
-        ]
-        
-        for i, color in enumerate(colors):
-            x_start = i * bar_width
-            x_end = x_start + bar_width if i < 6 else width
-            img[:, x_start:x_end] = color
-        
-        # Add a moving indicator
-        indicator_pos = (self.counter % width)
-        img[:, indicator_pos:indicator_pos+5] = [0, 0, 0]
+
+        frame = VideoFrame(self._width, self._height, "yuv420p")
+        render_bars(frame, _COLOR_BARS_BG, self.counter)
         
         self.counter += 5
         
-        frame = VideoFrame.from_ndarray(img, format="rgb24")
         frame.pts = pts
         frame.time_base = time_base
         return frame
 
 
 
+@functools.lru_cache(maxsize=None)
+def get_local_ip():
+    """Return this host's LAN IP, preferring a lookup over opening a socket."""
+    try:
+        local_ip = next(
+            info[4][0]
+            for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)
+        )
+    except (OSError, StopIteration):
+        local_ip = None
+
+    if local_ip is None or local_ip.startswith("127."):
+        # Hostname maps to loopback: ask the kernel which interface routes out
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 80))
+            local_ip = s.getsockname()[0]
+        finally:
+            s.close()
+    return local_ip
+
+
 async def detect_nat_type():
     """Detect NAT type by testing with STUN servers."""
-    global server_nat_info
+    global server_nat_info, server_nat_json
     
     try:
         print("\n[NAT DETECTION] Starting NAT type detection on server...")
         
         # Get local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
+        local_ip = get_local_ip()
         
         # Create ICE connection to gather candidates
         connection = aioice.Connection(ice_controlling=True, stun_server=("stun.l.google.com", 19302))
@@ -164,99 +235,127 @@ async def detect_nat_type():
             "nat_category": "error"
         }
 
+    server_nat_json = orjson.dumps(server_nat_info)
+
+
+# The demo page is read once; restart the server to pick up edits
+with open(os.path.join("static", "index.html"), "rb") as f:
+    _INDEX_HTML = f.read()
+_INDEX_ETAG = '"%s"' % hashlib.md5(_INDEX_HTML).hexdigest()
+
 
 async def index(request: web.Request):
     """Serve de demo pagina."""
-    return web.FileResponse(os.path.join("static", "index.html"))
+    if request.headers.get("If-None-Match") == _INDEX_ETAG:
+        return web.Response(status=304, headers={"ETag": _INDEX_ETAG})
+    return web.Response(
+        body=_INDEX_HTML,
+        content_type="text/html",
+        headers={"ETag": _INDEX_ETAG, "Cache-Control": "max-age=3600"},
+    )
 
 
 async def offer(request: web.Request):
     """Handel de offer van de WEB CLIENT af."""
     params = await request.json()
-    print("\n[PYTHON] Received offer from web client")
-    print("[PYTHON] Type:", params["type"])
-    print("[PYTHON] First 80 chars of SDP:\n", params["sdp"][:80], "...")
+    log.info("Received offer from web client")
+    log.debug("Type: %s", params["type"])
+    log.debug("First 80 chars of SDP:\n%s ...", params["sdp"][:80])
 
-    pc = RTCPeerConnection(configuration=stun_config)
+    # Certificate generation in the constructor is synchronous; keep it off
+    # the event loop so other peers' ICE and media aren't stalled by a burst
+    loop = asyncio.get_running_loop()
+    pc = await loop.run_in_executor(None, RTCPeerConnection, stun_config)
     pcs.add(pc)
+    gather_done = asyncio.Event()
 
     @pc.on("icegatheringstatechange")
     async def on_ice_gathering_state_change():
-        print("[PYTHON] ICE gathering state:", pc.iceGatheringState)
+        log.debug("ICE gathering state: %s", pc.iceGatheringState)
+        if pc.iceGatheringState == "complete":
+            gather_done.set()
 
     @pc.on("icecandidate")
     def on_ice_candidate(candidate):
         if candidate:
-            print(f"[PYTHON] ICE candidate: {candidate.candidate}")
+            log.debug("ICE candidate: %s", candidate.candidate)
         else:
-            print("[PYTHON] ICE candidate gathering complete (null candidate)")
+            log.debug("ICE candidate gathering complete (null candidate)")
 
     @pc.on("iceconnectionstatechange")
     async def on_ice_connection_state_change():
-        print(f"[PYTHON] ICE connection state: {pc.iceConnectionState}")
+        log.debug("ICE connection state: %s", pc.iceConnectionState)
         if pc.iceConnectionState == "connected":
-            print("[PYTHON] ✓ ICE CONNECTION ESTABLISHED!")
+            log.info("✓ ICE CONNECTION ESTABLISHED!")
         elif pc.iceConnectionState == "completed":
-            print("[PYTHON] ✓ ICE CONNECTION COMPLETED!")
+            log.info("✓ ICE CONNECTION COMPLETED!")
         elif pc.iceConnectionState in ("failed", "closed", "disconnected"):
-            print(f"[PYTHON] ✗ Connection issue - state: {pc.iceConnectionState}")
+            log.warning("✗ Connection issue - state: %s", pc.iceConnectionState)
             # Don't close immediately on disconnected, give it time to reconnect
             if pc.iceConnectionState in ("failed", "closed"):
-                print("[PYTHON] Closing peer connection")
+                log.info("Closing peer connection")
                 await pc.close()
                 pcs.discard(pc)
 
     @pc.on("track")
     def on_track(track):
-        print(f"[PYTHON] Track received: {track.kind}")
-        media_sink = MediaBlackhole()
-        media_sink.addTrack(track)
+        # Inbound media is never consumed; the answer below declines it
+        log.info("Track received: %s", track.kind)
 
     # Add video track to send back to the client
     video_track = ColorBarsVideoTrack()
     pc.addTrack(video_track)
-    print("[PYTHON] Added color bars video track to send to WEB CLIENT")
+    log.info("Added color bars video track to send to WEB CLIENT")
 
     # Remote description zetten (offer uit de browser)
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
     await pc.setRemoteDescription(offer)
 
-    print("[PYTHON] Creating answer…")
+    # Only send: the browser then keeps its camera RTP to itself, instead of
+    # us decoding and queueing every frame for a track nobody reads
+    for transceiver in pc.getTransceivers():
+        transceiver.direction = "sendonly"
+
+    log.debug("Creating answer…")
     answer = await pc.createAnswer()
     await pc.setLocalDescription(answer)
 
-    print("[PYTHON] Waiting for ICE gathering to complete...")
-    # In aiortc, ICE gathering happens in the background
-    # We need to wait longer for TURN server candidates
-    await asyncio.sleep(5.0)  # Give it 5 seconds to gather TURN candidates
+    log.debug("Waiting for ICE gathering to complete...")
+    # Wait until gathering reports complete, giving TURN candidates up to 5 seconds
+    if pc.iceGatheringState != "complete":
+        try:
+            await asyncio.wait_for(gather_done.wait(), timeout=5.0)
+        except asyncio.TimeoutError:
+            log.warning("ICE gathering timed out, answering with what we have")
     
-    print("[PYTHON] ICE gathering complete, sending answer back to WEB CLIENT")
+    log.debug("ICE gathering complete, sending answer back to WEB CLIENT")
     if pc.localDescription:
         candidate_count = pc.localDescription.sdp.count('a=candidate')
-        print(f"[PYTHON] Local description has {candidate_count} candidates")
+        log.debug("Local description has %d candidates", candidate_count)
         if candidate_count == 0:
-            print("[PYTHON] WARNING: No ICE candidates in SDP! Connection will likely fail.")
+            log.warning("No ICE candidates in SDP! Connection will likely fail.")
 
-    response = {
-        "sdp": pc.localDescription.sdp,
-        "type": pc.localDescription.type,
-        "nat_info": server_nat_info,  # Include NAT detection results
-    }
+    # Splice in the pre-encoded NAT detection results
+    body = (
+        b'{"sdp":' + orjson.dumps(pc.localDescription.sdp)
+        + b',"type":' + orjson.dumps(pc.localDescription.type)
+        + b',"nat_info":' + server_nat_json + b'}'
+    )
     return web.Response(
         content_type="application/json",
-        text=json.dumps(response),
+        body=body,
     )
 
 
 async def on_shutdown(app: web.Application):
-    coros = [pc.close() for pc in pcs]
-    await asyncio.gather(*coros)
+    # Snapshot and clear first so state-change handlers can't mutate pcs mid-close
+    snapshot = tuple(pcs)
     pcs.clear()
+    await asyncio.gather(*(pc.close() for pc in snapshot), return_exceptions=True)
 
 
 if __name__ == "__main__":
     # Enable aiortc logging for debugging
-    import logging
     logging.basicConfig(level=logging.INFO)
     
     print("Starting server on http://0.0.0.0:8085")